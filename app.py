@@ -1,60 +1,276 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import numpy as np
 import datetime
+import os
+import threading
 import plotly.express as px
 import folium
-from streamlit_folium import st_folium
+from folium.plugins import FastMarkerCluster
 from sklearn.ensemble import IsolationForest
+import joblib
+from joblib import Parallel, delayed
 import smtplib
 from email.mime.text import MIMEText
 from io import BytesIO
 
 # -------------------- CONFIG --------------------
 st.set_page_config(page_title="India Demand Pulse Dashboard", layout="wide")
-SECTORS = ["Retail", "Hospitality", "Finance"]
-REGIONS = ["Mumbai", "Delhi", "Chennai", "Kolkata", "Bengaluru", "Lucknow"]
+# Widget options, defined once here instead of inline at each widget
+SECTORS = ("Retail", "Hospitality", "Finance")
+REGIONS = ("Mumbai", "Delhi", "Chennai", "Kolkata", "Bengaluru", "Lucknow")
+PAYMENT_MODES = ("Cash", "Card", "UPI", "Wallet")
+EXPORT_FORMATS = ("CSV", "Excel")
+PAGES = (" Submit Pulse", " Sector Dashboard", " Alerts", " Citizen View", " Export", " Recent Submissions")
+ALERT_TEMPLATE = "⚠️ Alert: Unusual activity in {region} ({sector}) — Crowd Index {crowd_index}, Queue Time {queue_time} mins"
+ALERT_SUBJECT_TEMPLATE = "Alert: {sector} anomaly in {region}"
 DATA_FILE = "pulse_data.csv"
 ALERT_EMAIL = "your-alert-email@example.com"  # Replace with actual recipient
+MODEL_FILE = "iforest_{region}_{sector}.joblib"
+POOLED_MODEL_FILE = "iforest_pooled.joblib"
+MIN_SEGMENT_ROWS = 10  # Smaller (region, sector) segments share one pooled model
+MODEL_REFIT_FRACTION = 0.05  # Refit the saved model once the row count drifts by more than this
+COLUMNS = [
+    "timestamp", "region", "sector", "visitor_count", "top_items",
+    "queue_time", "payment_modes", "crowd_index"
+]
+ANOMALY_FEATURES = ["visitor_count", "queue_time", "crowd_index"]
+SCHEMA = {
+    "region": "category",
+    "sector": "category",
+    "payment_modes": "category",
+    "visitor_count": "int64",
+    "queue_time": "int64",
+    "crowd_index": "int8"
+}
 
 # -------------------- DATA INIT --------------------
-def load_data():
+# Hashes every row; Streamlit's default DataFrame hash only samples large frames
+FRAME_HASH = {pd.DataFrame: lambda df: pd.util.hash_pandas_object(df, index=False).values.tobytes()}
+
+def data_signature():
+    # (mtime, size) of the CSV; changes whenever any session appends to it
     try:
-        return pd.read_csv(DATA_FILE)
-    except:
-        return pd.DataFrame(columns=[
-            "timestamp", "region", "sector", "visitor_count", "top_items",
-            "queue_time", "payment_modes", "crowd_index"
-        ])
+        stat = os.stat(DATA_FILE)
+        return stat.st_mtime_ns, stat.st_size
+    except FileNotFoundError:
+        return None
 
-def save_data(df):
-    df.to_csv(DATA_FILE, index=False)
+# Keyed on the file signature, so a write from any session makes every session re-read
+@st.cache_data(max_entries=1)
+def load_data(signature):
+    try:
+        return pd.read_csv(DATA_FILE, dtype=SCHEMA, parse_dates=["timestamp"], engine="pyarrow")
+    except FileNotFoundError:
+        return pd.DataFrame(columns=COLUMNS).astype({**SCHEMA, "timestamp": "datetime64[ns]"})
 
-# -------------------- ALERT FUNCTION --------------------
-def send_alert_email(subject, body):
-    sender = "your-sender-email@example.com"
-    password = "your-email-password"  # Use secrets in production
-    recipient = ALERT_EMAIL
+def save_data(rows):
+    # Append only the new rows; the header is written once when the file is created
+    text = rows.to_csv(header=not os.path.exists(DATA_FILE), index=False)
+    with open(DATA_FILE, "a", encoding="utf-8", newline="") as f:
+        f.write(text)
+    return len(text.encode("utf-8"))
+
+def append_rows(df, rows):
+    # Concatenate without losing SCHEMA: both sides share categories so concat keeps them categorical
+    rows = rows.astype(SCHEMA)
+    df = df.copy(deep=False)
+    for col, dtype in SCHEMA.items():
+        if dtype == "category":
+            categories = df[col].cat.categories.union(rows[col].cat.categories)
+            df[col] = df[col].cat.set_categories(categories)
+            rows[col] = rows[col].cat.set_categories(categories)
+    return pd.concat([df, rows], ignore_index=True)
+
+@st.cache_data(hash_funcs=FRAME_HASH)
+def latest_map(df):
+    # Most recent submission per (region, sector), on a sorted MultiIndex for direct lookup
+    latest_idx = df.groupby(["region", "sector"], observed=True)["timestamp"].idxmax()
+    return df.loc[latest_idx].set_index(["region", "sector"]).sort_index()
+
+def record_submission(row):
+    # Written to disk before returning so an accepted submission is never held only in memory
+    before = data_signature()
+    written = save_data(pd.DataFrame([row], columns=COLUMNS))
+    after = data_signature()
+    latest_map.clear()
+    # If nobody else wrote in between, the session copy stays valid once this row is folded in
+    start_size = before[1] if before else 0
+    if "data" in st.session_state and st.session_state["data_signature"] == before and after[1] == start_size + written:
+        st.session_state["data_signature"] = after
+        st.session_state.setdefault("pending", []).append(row)
+
+def current_data():
+    # Session copy of the data, reloaded whenever the CSV has changed on disk
+    signature = data_signature()
+    if "data" not in st.session_state or st.session_state["data_signature"] != signature:
+        st.session_state["data"] = load_data(signature)
+        st.session_state["data_signature"] = signature
+        st.session_state["pending"] = []
+    elif st.session_state.get("pending"):
+        # Rows this session already wrote to disk, folded in with one concat however many there are
+        rows = pd.DataFrame(st.session_state["pending"], columns=COLUMNS)
+        st.session_state["data"] = append_rows(st.session_state["data"], rows)
+        st.session_state["pending"] = []
+    return st.session_state["data"]
+
+# -------------------- ANOMALY MODEL --------------------
+def load_or_fit_iforest(path, features, segments):
+    # Reuse the model saved by an earlier process while it covers the same (region, sector)
+    # segments and the data is close to what it was fit on
+    n_rows = len(features)
+    try:
+        saved = joblib.load(path, mmap_mode="r")
+        if (saved["columns"] == ANOMALY_FEATURES and saved["segments"] == segments
+                and abs(n_rows - saved["n_rows"]) <= MODEL_REFIT_FRACTION * n_rows):
+            return saved["model"]
+    except Exception:
+        # Missing, truncated or incompatible (e.g. another sklearn version) files are refit
+        pass
+    model = IsolationForest(contamination=0.1, n_estimators=100, random_state=0).fit(features)
+    # Write to a private temp file and swap it in so readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        joblib.dump({"columns": ANOMALY_FEATURES, "segments": segments, "n_rows": n_rows, "model": model}, tmp_path)
+        os.replace(tmp_path, path)
+    except OSError:
+        # Saving is only a cache; a read-only or full disk must not cost the fitted model
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return model
+
+def _score_rows(path, rows, segments):
+    # Anomaly labels (-1 = anomaly) for one group of rows, indexed like the rows
+    features = rows[ANOMALY_FEATURES].to_numpy(dtype=np.float32)
+    model = load_or_fit_iforest(path, features, segments)
+    return pd.Series(model.predict(features), index=rows.index)
+
+@st.cache_data(hash_funcs=FRAME_HASH)
+def detect_anomalies(df):
+    # Returns (labels, unscored segments). Segments too small for their own forest are
+    # pooled into one shared forest; they are only left unscored if the pool is too small too
+    segments = list(df.groupby(["region", "sector"], observed=True))
+    jobs = [
+        delayed(_score_rows)(MODEL_FILE.format(region=region, sector=sector), segment, [(str(region), str(sector))])
+        for (region, sector), segment in segments if len(segment) >= MIN_SEGMENT_ROWS
+    ]
+    small = [(key, segment) for key, segment in segments if len(segment) < MIN_SEGMENT_ROWS]
+    unscored = []
+    if sum(len(segment) for _, segment in small) >= MIN_SEGMENT_ROWS:
+        pooled_keys = sorted((str(region), str(sector)) for (region, sector), _ in small)
+        jobs.append(delayed(_score_rows)(POOLED_MODEL_FILE, pd.concat([segment for _, segment in small]), pooled_keys))
+    else:
+        unscored = [key for key, _ in small]
+
+    # IsolationForest releases the GIL, so threads fit the groups in parallel without copying data
+    labels = Parallel(n_jobs=-1, prefer="threads")(jobs)
+    labels = pd.concat(labels) if labels else pd.Series(1, index=df.index)
+    return labels.reindex(df.index, fill_value=1), unscored
 
+# -------------------- ALERT FUNCTION --------------------
+def build_alert_message(sender, recipient, subject, body):
     msg = MIMEText(body)
     msg["Subject"] = subject
     msg["From"] = sender
     msg["To"] = recipient
+    return msg
+
+def send_alert_emails(alerts):
+    # One TLS session and login for the whole batch of (subject, body) alerts
+    sender = "your-sender-email@example.com"
+    password = "your-email-password"  # Use secrets in production
+    recipient = ALERT_EMAIL
 
+    failures = 0
     try:
         with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
             server.login(sender, password)
-            server.sendmail(sender, recipient, msg.as_string())
-        st.success(" Alert email sent successfully!")
+            for subject, body in alerts:
+                try:
+                    server.sendmail(sender, recipient, build_alert_message(sender, recipient, subject, body).as_string())
+                except smtplib.SMTPException as e:
+                    failures += 1
+                    # Stop early once more than a third of the batch has failed
+                    if failures * 3 > len(alerts):
+                        st.error(f" Aborted alert emails after {failures} failures: {e}")
+                        return
+        st.success(f" {len(alerts) - failures} alert email(s) sent successfully!")
     except Exception as e:
-        st.error(f" Failed to send alert: {e}")
+        st.error(f" Failed to send alerts: {e}")
+
+# -------------------- CHART FUNCTION --------------------
+@st.cache_data(hash_funcs=FRAME_HASH)
+def visitors_by_region(df):
+    # Aggregated server-side so the chart ships one row per region
+    return df.groupby("region", observed=True, as_index=False)["visitor_count"].sum()
+
+# -------------------- MAP FUNCTION --------------------
+MAP_AGGREGATE_ABOVE = 2000  # Rows beyond which the map shows grid-cell aggregates
+MAP_GRID_DEG = 1.0
+# Each point is [lat, lon, crowd_index, label]; rendered client-side in one layer
+MARKER_CALLBACK = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {radius: row[2], color: "red", fill: true});
+    marker.bindPopup(row[3] + " (" + row[2] + ")");
+    return marker;
+}
+"""
+
+# Keyed on the full content hash so the rendered map is reused until the rows change
+@st.cache_data(hash_funcs=FRAME_HASH)
+def build_heatmap(df):
+    m = folium.Map(location=[20.5937, 78.9629], zoom_start=4, control_scale=True)
+    # Seeded so the same rows always land on the same coordinates
+    rng = np.random.default_rng(42)
+    coords = rng.uniform(low=[8, 68], high=[37, 97], size=(len(df), 2))
+    lats, lons = coords[:, 0], coords[:, 1]
+    if len(df) > MAP_AGGREGATE_ABOVE:
+        # Too many rows to ship individually: send one point per grid cell instead
+        cells = pd.DataFrame({
+            "lat": (np.floor(lats / MAP_GRID_DEG) + 0.5) * MAP_GRID_DEG,
+            "lon": (np.floor(lons / MAP_GRID_DEG) + 0.5) * MAP_GRID_DEG,
+            "crowd_index": df["crowd_index"].to_numpy()
+        })
+        cells = cells.groupby(["lat", "lon"], as_index=False).agg(
+            crowd_index=("crowd_index", "mean"), count=("crowd_index", "size")
+        )
+        labels = [f"{c} submissions" for c in cells["count"].tolist()]
+        points = [list(p) for p in zip(cells["lat"].tolist(), cells["lon"].tolist(), cells["crowd_index"].round(1).tolist(), labels)]
+    else:
+        points = [list(p) for p in zip(lats.tolist(), lons.tolist(), df["crowd_index"].tolist(), df["region"].tolist())]
+    FastMarkerCluster(points, callback=MARKER_CALLBACK).add_to(m)
+    return m._repr_html_()
+
+# -------------------- EXPORT FUNCTIONS --------------------
+@st.cache_data(hash_funcs=FRAME_HASH)
+def to_csv_bytes(df):
+    # Arrow's multithreaded C++ writer instead of pandas' per-cell Python formatting
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # Microsecond timestamps, matching pulse_data.csv instead of Arrow's nanosecond default
+    ts = table.schema.get_field_index("timestamp")
+    table = table.set_column(ts, "timestamp", table.column(ts).cast(pa.timestamp("us"), safe=False))
+    buf = pa.BufferOutputStream()
+    pacsv.write_csv(table, buf)
+    return buf.getvalue().to_pybytes()
+
+@st.cache_data(hash_funcs=FRAME_HASH)
+def to_xlsx_bytes(df):
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+        df.to_excel(writer, index=False, sheet_name="PulseData")
+    return output.getvalue()
 
 # -------------------- SIDEBAR --------------------
 st.sidebar.title("Navigation")
-page = st.sidebar.radio("Go to", [" Submit Pulse", " Sector Dashboard", " Alerts", " Citizen View", " Export", " Recent Submissions"])
+page = st.sidebar.radio("Go to", PAGES)
 
 # -------------------- PAGE 1: SUBMISSION FORM --------------------
-if page == " Submit Pulse":
+def submit_page():
     st.title(" Submit Daily Pulse Data")
     with st.form("pulse_form"):
         region = st.selectbox("Region", REGIONS)
@@ -62,13 +278,12 @@ if page == " Submit Pulse":
         visitor_count = st.number_input("Visitor Count", min_value=0)
         top_items = st.text_input("Top-Selling Items / Services")
         queue_time = st.number_input("Average Queue Time (minutes)", min_value=0)
-        payment_modes = st.multiselect("Payment Breakdown", ["Cash", "Card", "UPI", "Wallet"])
+        payment_modes = st.multiselect("Payment Breakdown", PAYMENT_MODES)
         crowd_index = st.slider("Crowd Index (0 = Empty, 10 = Overwhelmed)", 0, 10)
         submitted = st.form_submit_button("Submit")
 
     if submitted:
-        data = load_data()
-        new_entry = pd.DataFrame([{
+        record_submission({
             "timestamp": datetime.datetime.now(),
             "region": region,
             "sector": sector,
@@ -77,16 +292,16 @@ if page == " Submit Pulse":
             "queue_time": queue_time,
             "payment_modes": ",".join(payment_modes),
             "crowd_index": crowd_index
-        }])
-        updated_data = pd.concat([data, new_entry], ignore_index=True)
-        save_data(updated_data)
+        })
         st.success("✅ Data submitted successfully!")
-        st.experimental_rerun()
+        st.rerun()
 
 # -------------------- PAGE 2: DASHBOARD --------------------
-elif page == " Sector Dashboard":
+# Fragments rerun on their own widget events without re-executing the whole script
+@st.fragment
+def dashboard_page():
     st.title(" Sector-Wise Demand Dashboard")
-    data = load_data()
+    data = current_data()
     sector = st.selectbox("Select Sector", SECTORS)
     filtered = data[data["sector"] == sector]
 
@@ -95,80 +310,84 @@ elif page == " Sector Dashboard":
         st.metric("Average Crowd Index", round(filtered["crowd_index"].mean(), 2))
         st.metric("Average Queue Time", round(filtered["queue_time"].mean(), 2))
     with col2:
-        fig = px.histogram(filtered, x="region", y="visitor_count", color="region", title="Visitor Count by Region")
+        fig = px.bar(visitors_by_region(filtered), x="region", y="visitor_count", color="region", title="Visitor Count by Region")
         st.plotly_chart(fig, use_container_width=True)
 
     st.subheader(" Crowd Heatmap")
     if not filtered.empty:
-        m = folium.Map(location=[20.5937, 78.9629], zoom_start=4, control_scale=True)
-        for _, row in filtered.iterrows():
-            lat = np.random.uniform(8, 37)
-            lon = np.random.uniform(68, 97)
-            folium.CircleMarker(
-                location=[lat, lon],
-                radius=row["crowd_index"],
-                popup=f"{row['region']} ({row['crowd_index']})",
-                color="red",
-                fill=True
-            ).add_to(m)
-        st_folium(m, width=700)
+        components.html(build_heatmap(filtered), width=700, height=500)
 
 # -------------------- PAGE 3: ALERTS --------------------
-elif page == " Alerts":
+def alerts_page():
     st.title(" Real-Time Surge & Anomaly Alerts")
-    data = load_data()
-    if len(data) < 10:
+    data = current_data()
+    if len(data) < MIN_SEGMENT_ROWS:
         st.warning("Not enough data for anomaly detection.")
-    else:
-        model = IsolationForest(contamination=0.1)
-        features = data[["visitor_count", "queue_time", "crowd_index"]]
-        data["anomaly"] = model.fit_predict(features)
-        alerts = data[data["anomaly"] == -1]
-
-        for _, row in alerts.iterrows():
-            alert_msg = f"⚠️ Alert: Unusual activity in {row['region']} ({row['sector']}) — Crowd Index {row['crowd_index']}, Queue Time {row['queue_time']} mins"
-            st.error(alert_msg)
-            send_alert_email(
-                subject=f"Alert: {row['sector']} anomaly in {row['region']}",
-                body=alert_msg
-            )
+        return
+
+    anomaly, unscored = detect_anomalies(data[["region", "sector", *ANOMALY_FEATURES]])
+    if unscored:
+        st.warning("Not enough data to score: " + ", ".join(f"{region} ({sector})" for region, sector in unscored))
+    alerts = data[anomaly == -1]
+
+    messages = []
+    rows = alerts[["region", "sector", "crowd_index", "queue_time"]].itertuples(index=False, name=None)
+    for region, sector, crowd_index, queue_time in rows:
+        alert_msg = ALERT_TEMPLATE.format(region=region, sector=sector, crowd_index=crowd_index, queue_time=queue_time)
+        st.error(alert_msg)
+        messages.append((ALERT_SUBJECT_TEMPLATE.format(region=region, sector=sector), alert_msg))
+    if messages:
+        send_alert_emails(messages)
 
 # -------------------- PAGE 4: CITIZEN VIEW --------------------
-elif page == " Citizen View":
+@st.fragment
+def citizen_page():
     st.title(" Citizen Pulse — Check Crowd Levels")
-    data = load_data()
+    data = current_data()
     region = st.selectbox("Your Region", REGIONS)
     sector = st.selectbox("Service Type", SECTORS)
-    latest = data[(data["region"] == region) & (data["sector"] == sector)].sort_values("timestamp", ascending=False).head(1)
+    latest = latest_map(data)
 
-    if latest.empty:
+    if (region, sector) not in latest.index:
         st.info("No recent data available for your selection.")
     else:
-        row = latest.iloc[0]
+        row = latest.loc[(region, sector)]
         st.metric("Crowd Index", row["crowd_index"])
         st.metric("Queue Time", f"{row['queue_time']} mins")
         st.write(f"Top Requests: {row['top_items']}")
         st.write(f"Payment Modes: {row['payment_modes']}")
 
 # -------------------- PAGE 5: EXPORT --------------------
-elif page == " Export":
+@st.fragment
+def export_page():
     st.title(" Export Data for Policy Teams")
-    data = load_data()
-    export_format = st.radio("Choose Format", ["CSV", "Excel"])
+    data = current_data()
+    export_format = st.radio("Choose Format", EXPORT_FORMATS)
     if export_format == "CSV":
-        st.download_button("Download CSV", data.to_csv(index=False), file_name="pulse_data.csv")
+        st.download_button("Download CSV", to_csv_bytes(data), file_name="pulse_data.csv")
     else:
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            data.to_excel(writer, index=False, sheet_name='PulseData')
-        st.download_button("Download Excel", output.getvalue(), file_name="pulse_data.xlsx")
+        st.download_button("Download Excel", to_xlsx_bytes(data), file_name="pulse_data.xlsx")
 
 # -------------------- PAGE 6: RECENT SUBMISSIONS --------------------
-elif page == " Recent Submissions":
+def recent_page():
     st.title(" Recent Pulse Submissions")
-    data = load_data()
+    data = current_data()
     st.dataframe(data.sort_values("timestamp", ascending=False).head(20))
 
+# -------------------- PAGE DISPATCH --------------------
+if page == " Submit Pulse":
+    submit_page()
+elif page == " Sector Dashboard":
+    dashboard_page()
+elif page == " Alerts":
+    alerts_page()
+elif page == " Citizen View":
+    citizen_page()
+elif page == " Export":
+    export_page()
+elif page == " Recent Submissions":
+    recent_page()
+
 # -------------------- FOOTER --------------------
 st.markdown("---")
 st.caption("Built for India’s Smart Governance • Privacy-Safe • Scalable • Open Source")